@@ -1,8 +1,18 @@
-from fastapi import FastAPI, HTTPException, Header, Request
-from pydantic import BaseModel, Field
-from typing import Optional
-from .salesforce_client import update_serial_in_salesforce
+from fastapi import Depends, FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse
+from fastapi.security import APIKeyHeader
+from pydantic import BaseModel, Field, TypeAdapter
+from pydantic import ValidationError as PydanticValidationError
+from pydantic.json_schema import models_json_schema
+from typing import Dict, List, Literal, Optional, Union
+from contextlib import asynccontextmanager
+from .salesforce_client import update_serial_in_salesforce, get_client, close_client
+import email.message
+import hmac
 import json
+import msgspec
+import os
 from pathlib import Path
 import logging
 
@@ -13,17 +23,30 @@ logging.basicConfig(
     format="%(asctime)s [%(levelname)s] %(name)s - %(message)s",
 )
 
-app = FastAPI(title="Middleware Técnicos → Salesforce")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Cliente HTTP compartido hacia Salesforce: se crea al iniciar y se cierra al apagar
+    get_client()
+    yield
+    await close_client()
+
+
+app = FastAPI(
+    title="Middleware Técnicos → Salesforce",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 
 # ========== MIDDLEWARE DE LOG GLOBAL ==========
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
     # Log de entrada
-    logger.info(f"👉 {request.method} {request.url.path}")
+    logger.info("👉 %s %s", request.method, request.url.path)
 
-    # Para debug: loguear headers básicos
-    logger.info(f"Headers: {dict(request.headers)}")
+    # Para debug: loguear headers (solo si está habilitado DEBUG)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Headers: %s", request.headers.raw)
 
     # Si querés ver el body crudo de TODO, descomentá esto (ojo que consume el body):
     # body_bytes = await request.body()
@@ -33,16 +56,22 @@ async def log_requests(request: Request, call_next):
     response = await call_next(request)
 
     # Log de salida
-    logger.info(f"👈 {request.method} {request.url.path} -> {response.status_code}")
+    logger.info("👈 %s %s -> %s", request.method, request.url.path, response.status_code)
     return response
 
 
 # ===== Modelos de entrada/salida =====
+# Los modelos de respuesta solo documentan el OpenAPI: los handlers devuelven
+# ORJSONResponse con dicts armados por nosotros, sin re-validación de salida.
+
+# Roles aceptados por el picklist de Salesforce (se validan en pydantic-core al parsear)
+Role = Literal["Limpieza", "Programación"]
+
 
 class ProcessSerialRequest(BaseModel):
     serial: str = Field(..., min_length=1)
     technicianName: str = Field(..., min_length=1)
-    role: str = Field(..., min_length=1)
+    role: Role
 
 
 class ProcessSerialResponse(BaseModel):
@@ -73,97 +102,316 @@ class LoginResponse(BaseModel):
     error_code: Optional[str] = None
 
 
+# ===== Modelos de error de validación (solo OpenAPI, mismo esquema que FastAPI) =====
+
+class ValidationError(BaseModel):
+    loc: List[Union[str, int]] = Field(..., title="Location")
+    msg: str = Field(..., title="Message")
+    type: str = Field(..., title="Error Type")
+
+
+class HTTPValidationError(BaseModel):
+    detail: List[ValidationError] = Field(default_factory=list)
+
+
 # API key simple para que solo la app de técnicos pueda llamar
-API_KEY = "123"  # luego lo pasamos a .env
+# Se guarda en bytes para que compare_digest no tenga que codificarla en cada request
+API_KEY = os.getenv("API_KEY", "123").encode()
+
+# Dependencia compartida por todos los endpoints para leer el header X-API-Key
+_API_KEY_DEP = APIKeyHeader(name="X-API-Key", auto_error=False)
 
 
 # "Base de datos" dummy de usuarios (solo para desarrollo)
 USERS_DB_PATH = Path("config/users.json")
 
 
-def load_users_db() -> dict:
+class UserRec(msgspec.Struct, frozen=True):
+    """
+    Usuario tal como está en users.json (se decodifica una sola vez con msgspec).
+    """
+    password: str
+    technicianName: str
+    role: str
+    email: Optional[str] = None
+
+
+# Entrada de la base: (password en bytes, precalculada al cargar, y el usuario)
+UserEntry = tuple[bytes, UserRec]
+
+
+# Password dummy para comparar cuando el usuario no existe (mismo tiempo de respuesta)
+_DUMMY_PASSWORD = b"\x00" * 32
+
+
+def load_users_db() -> Dict[str, UserEntry]:
     """
     Carga la base de usuarios desde un archivo JSON.
-    Si falla, devuelve un dict vacío.
+    Si el archivo no se puede leer o no es un objeto JSON válido, lanza la excepción
+    (OSError / msgspec.DecodeError); get_users decide qué base seguir usando.
+    """
+    raw_users = msgspec.json.decode(USERS_DB_PATH.read_bytes(), type=Dict[str, msgspec.Raw])
+
+    # Cada usuario se valida por separado: uno inválido se descarta sin afectar al resto
+    data: Dict[str, UserEntry] = {}
+    for username, raw in raw_users.items():
+        try:
+            user = msgspec.json.decode(raw, type=UserRec)
+        except msgspec.DecodeError as e:
+            logger.warning("Usuario inválido en users.json, se ignora: %s (%s)", username, e)
+            continue
+        data[username] = (user.password.encode(), user)
+
+    logger.info("USERS_DB cargada con %s usuarios desde %s", len(data), USERS_DB_PATH)
+    return data
+
+
+# Clave (st_mtime_ns, st_size) del último intento de carga, exitoso o no.
+# Mientras no cambie, no se vuelve a leer el archivo (ni se repiten los logs).
+_USERS_KEY: Optional[tuple[int, int]] = None
+_USERS_MISSING_KEY = (-1, -1)
+
+# Base vigente. Si users.json está a medio escribir o es inválido, se mantiene la
+# última cargada con éxito; si el archivo no existe, no hay usuarios (igual que al iniciar).
+_USERS: Dict[str, UserEntry] = {}
+
+
+def get_users() -> Dict[str, UserEntry]:
     """
+    Devuelve la base de usuarios, cargándola recién en el primer uso.
+    Si users.json cambia (mtime o tamaño distinto) se vuelve a leer sin reiniciar la app.
+    """
+    global _USERS_KEY, _USERS
+
     try:
-        with USERS_DB_PATH.open("r", encoding="utf-8") as f:
-            data = json.load(f)
-            if isinstance(data, dict):
-                logger.info(f"USERS_DB cargada con {len(data)} usuarios desde {USERS_DB_PATH}")
-                return data
-            logger.warning("users.json no contiene un objeto dict en la raíz")
-            return {}
+        st = USERS_DB_PATH.stat()
+        key = (st.st_mtime_ns, st.st_size)
     except FileNotFoundError:
-        logger.warning(f"Archivo de usuarios no encontrado: {USERS_DB_PATH}")
-        return {}
+        key = _USERS_MISSING_KEY
+
+    if key == _USERS_KEY:
+        return _USERS
+    _USERS_KEY = key
+
+    if key == _USERS_MISSING_KEY:
+        logger.warning("Archivo de usuarios no encontrado: %s", USERS_DB_PATH)
+        _USERS = {}
+        return _USERS
+
+    try:
+        _USERS = load_users_db()
+    except (OSError, msgspec.DecodeError) as e:
+        logger.error("users.json inválido, se mantiene la última base cargada: %s", e)
+    return _USERS
+
+
+# ===== Parseo de body =====
+
+# Validadores armados una sola vez al importar, reusados en cada request
+_LOGIN_ADAPTER = TypeAdapter(LoginRequest)
+_PROCESS_ADAPTER = TypeAdapter(ProcessSerialRequest)
+
+# Modelos de body que registramos en components/schemas del OpenAPI (ver _openapi)
+_BODY_MODELS = (LoginRequest, ProcessSerialRequest)
+
+
+# El 422 lo documentaba FastAPI solo; como parseamos el body a mano, lo agregamos nosotros
+_BODY_RESPONSES = {422: {"model": HTTPValidationError, "description": "Validation Error"}}
+
+
+def _is_json_content_type(content_type: Optional[str]) -> bool:
+    """
+    Mismo criterio que FastAPI: sin Content-Type se asume JSON; si no, */json o */*+json.
+    """
+    if not content_type:
+        return True
+    message = email.message.Message()
+    message["content-type"] = content_type
+    if message.get_content_maintype() != "application":
+        return False
+    subtype = message.get_content_subtype()
+    return subtype == "json" or subtype.endswith("+json")
+
+
+def _body_openapi(model: type[BaseModel]) -> dict:
+    """
+    requestBody para el OpenAPI, ya que el body no pasa por la inyección de FastAPI.
+    Referencia al modelo en components/schemas, igual que lo generaba FastAPI.
+    """
+    return {
+        "requestBody": {
+            "content": {
+                "application/json": {
+                    "schema": {"$ref": f"#/components/schemas/{model.__name__}"}
+                }
+            },
+            "required": True,
+        }
+    }
+
+
+def _openapi() -> dict:
+    """
+    OpenAPI de FastAPI más los esquemas de _BODY_MODELS (y sus modelos anidados).
+    """
+    if app.openapi_schema:
+        return app.openapi_schema
+
+    schema = FastAPI.openapi(app)
+    _, defs = models_json_schema(
+        [(model, "validation") for model in _BODY_MODELS],
+        ref_template="#/components/schemas/{model}",
+    )
+    schemas = schema.setdefault("components", {}).setdefault("schemas", {})
+    schemas.update(defs.get("$defs", {}))
+    schema["components"]["schemas"] = dict(sorted(schemas.items()))
+    return schema
+
+
+app.openapi = _openapi
+
+
+def _raise_json_error(body: bytes) -> None:
+    """
+    Reproduce el error de FastAPI para un body que no es JSON válido (solo en el camino
+    de error): 422 json_invalid con la posición en loc, o 400 si no es UTF-8.
+    """
+    try:
+        json.loads(body)
     except json.JSONDecodeError as e:
-        logger.error(f"Error parseando users.json: {e}")
-        return {}
+        raise RequestValidationError(
+            [{
+                "type": "json_invalid",
+                "loc": ("body", e.pos),
+                "msg": "JSON decode error",
+                "input": {},
+                "ctx": {"error": e.msg},
+            }],
+            body=e.doc,
+        ) from e
+    except UnicodeDecodeError as e:
+        raise HTTPException(status_code=400, detail="There was an error parsing the body") from e
+
+
+def _body_error(err: dict) -> dict:
+    """
+    Adapta un error de validate_json al formato de FastAPI: loc con prefijo "body", y
+    un body JSON que no es objeto se informa como model_attributes_type (igual que FastAPI).
+    """
+    if err["type"] == "model_type" and not err["loc"]:
+        return {
+            "type": "model_attributes_type",
+            "loc": ("body",),
+            "msg": "Input should be a valid dictionary or object to extract fields from",
+            "input": err["input"],
+        }
+    return {**err, "loc": ("body", *err["loc"])}
 
 
-# Cargamos una vez al iniciar la app
-USERS_DB = load_users_db()
+async def _parse_body(request: Request, adapter: TypeAdapter):
+    """
+    Parsea y valida el body en una sola pasada (validate_json / jiter).
+    Si no es JSON o no valida, responde 422 con el mismo formato que FastAPI.
+    """
+    body = await request.body()
+    if not body:
+        raise RequestValidationError(
+            [{"type": "missing", "loc": ("body",), "msg": "Field required", "input": None}]
+        )
+    if not _is_json_content_type(request.headers.get("content-type")):
+        raise RequestValidationError([{
+            "type": "model_attributes_type",
+            "loc": ("body",),
+            "msg": "Input should be a valid dictionary or object to extract fields from",
+            "input": body,
+        }])
+    try:
+        return adapter.validate_json(body)
+    except PydanticValidationError as e:
+        errors = e.errors(include_url=False)
+        if any(err["type"] == "json_invalid" for err in errors):
+            _raise_json_error(body)
+        raise RequestValidationError([_body_error(err) for err in errors])
 
 
 # ===== Endpoint LOGIN =====
 
-@app.post("/login", response_model=LoginResponse)
+@app.post(
+    "/login",
+    responses={200: {"model": LoginResponse}, **_BODY_RESPONSES},
+    openapi_extra=_body_openapi(LoginRequest),
+)
 async def login(
-    payload: LoginRequest,
-    x_api_key: Optional[str] = Header(default=None),
+    request: Request,
+    x_api_key: Optional[str] = Depends(_API_KEY_DEP),
 ):
+    payload: LoginRequest = await _parse_body(request, _LOGIN_ADAPTER)
+
     logger.info(f"🔐 /login llamado con username={payload.username}")
 
     # 1) Validar API key
-    if x_api_key != API_KEY:
+    if not hmac.compare_digest((x_api_key or "").encode(), API_KEY):
         logger.warning(f"/login API key inválida: {x_api_key}")
         raise HTTPException(status_code=401, detail="API key inválida")
 
-    # 2) Buscar usuario
-    user = USERS_DB.get(payload.username)
+    # 2) Buscar usuario (comparación en tiempo constante, aun si no existe)
+    entry = get_users().get(payload.username)
+    password_ok = hmac.compare_digest(
+        entry[0] if entry else _DUMMY_PASSWORD, payload.password.encode()
+    )
 
-    if not user or payload.password != user["password"]:
+    if not entry or not password_ok:
         logger.warning(
             f"Intento de login fallido para username={payload.username}"
         )
-        return LoginResponse(
-            ok=False,
-            message="Usuario o contraseña incorrectos",
-            user=None,
-            error_code="INVALID_CREDENTIALS",
+        return ORJSONResponse(
+            content={
+                "ok": False,
+                "message": "Usuario o contraseña incorrectos",
+                "user": None,
+                "error_code": "INVALID_CREDENTIALS",
+            }
         )
 
-    # 3) Login OK → armar objeto user
-    user_info = UserInfo(
-        username=payload.username,
-        technicianName=user["technicianName"],
-        role=user["role"],
-        email=user.get("email"),
-    )
+    # 3) Login OK → armar objeto user (dict directo, sin construir modelos Pydantic)
+    user = entry[1]
+    user_info = {
+        "username": payload.username,
+        "technicianName": user.technicianName,
+        "role": user.role,
+        "email": user.email,
+    }
 
     logger.info(
         f"Login exitoso para username={payload.username}, "
-        f"technicianName={user['technicianName']}, role={user['role']}"
+        f"technicianName={user.technicianName}, role={user.role}"
     )
 
-    return LoginResponse(
-        ok=True,
-        message="Login exitoso",
-        user=user_info,
-        error_code=None,
+    return ORJSONResponse(
+        content={
+            "ok": True,
+            "message": "Login exitoso",
+            "user": user_info,
+            "error_code": None,
+        }
     )
 
 
 # ===== Endpoint PROCESS-SERIAL =====
 
-@app.post("/process-serial", response_model=ProcessSerialResponse)
+@app.post(
+    "/process-serial",
+    responses={200: {"model": ProcessSerialResponse}, **_BODY_RESPONSES},
+    openapi_extra=_body_openapi(ProcessSerialRequest),
+)
 async def process_serial(
-    payload: ProcessSerialRequest,
-    x_api_key: Optional[str] = Header(default=None),
+    request: Request,
+    x_api_key: Optional[str] = Depends(_API_KEY_DEP),
 ):
+    payload: ProcessSerialRequest = await _parse_body(request, _PROCESS_ADAPTER)
+
     # 👇 log explícito del JSON que envía la app
-    logger.info(f"📦 /process-serial JSON recibido: {payload.dict()}")
+    logger.info("📦 /process-serial JSON recibido: %r", payload)
 
     logger.info(
         f"🚚 /process-serial llamado con serial={payload.serial}, "
@@ -171,7 +419,7 @@ async def process_serial(
     )
 
     # 1) Seguridad básica
-    if x_api_key != API_KEY:
+    if not hmac.compare_digest((x_api_key or "").encode(), API_KEY):
         logger.warning(f"/process-serial API key inválida: {x_api_key}")
         raise HTTPException(status_code=401, detail="API key inválida")
 
@@ -184,10 +432,13 @@ async def process_serial(
         )
     except Exception as e:
         logger.exception(f"Error interno llamando a Salesforce: {e}")
-        return ProcessSerialResponse(
-            ok=False,
-            message="Error interno llamando a Salesforce",
-            error_code="SF_INTERNAL_ERROR",
+        return ORJSONResponse(
+            content={
+                "ok": False,
+                "message": "Error interno llamando a Salesforce",
+                "salesforce_id": None,
+                "error_code": "SF_INTERNAL_ERROR",
+            }
         )
 
     # 4) Interpretar el resultado normalizado de salesforce_client
@@ -196,13 +447,16 @@ async def process_serial(
             f"/process-serial éxito para serial={payload.serial}, "
             f"salesforce_id={result.get('salesforce_id')}"
         )
-        return ProcessSerialResponse(
-            ok=True,
-            message=result.get(
-                "message",
-                f"Serial {payload.serial} actualizado correctamente en Salesforce",
-            ),
-            salesforce_id=result.get("salesforce_id"),
+        return ORJSONResponse(
+            content={
+                "ok": True,
+                "message": result.get(
+                    "message",
+                    f"Serial {payload.serial} actualizado correctamente en Salesforce",
+                ),
+                "salesforce_id": result.get("salesforce_id"),
+                "error_code": None,
+            }
         )
 
     logger.warning(
@@ -210,8 +464,11 @@ async def process_serial(
         f"message={result.get('message')}, error_code={result.get('error_code')}"
     )
 
-    return ProcessSerialResponse(
-        ok=False,
-        message=result.get("message", "Error desconocido en Salesforce"),
-        error_code=result.get("error_code"),
+    return ORJSONResponse(
+        content={
+            "ok": False,
+            "message": result.get("message", "Error desconocido en Salesforce"),
+            "salesforce_id": None,
+            "error_code": result.get("error_code"),
+        }
     )
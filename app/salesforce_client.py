@@ -1,7 +1,11 @@
+import asyncio
 import os
-from typing import Dict, Any
+import time
+import urllib.parse
+from typing import Dict, Any, Optional
 
 import httpx
+import msgspec
 
 # === CONFIGURACIÓN SALESFORCE ===
 
@@ -12,28 +16,94 @@ SF_TOKEN_URL = f"{SF_BASE_URL}/services/oauth2/token"
 SF_CLIENT_ID = os.getenv("SF_CLIENT_ID")         # Consumer Key
 SF_CLIENT_SECRET = os.getenv("SF_CLIENT_SECRET") # Consumer Secret
 
-# Cache simple de token en memoria
+# Body y headers constantes: se arman una sola vez al importar
+_TOKEN_BODY: bytes | None = (
+    urllib.parse.urlencode({
+        "grant_type": "client_credentials",
+        "client_id": SF_CLIENT_ID,
+        "client_secret": SF_CLIENT_SECRET,
+    }).encode()
+    if SF_CLIENT_ID and SF_CLIENT_SECRET
+    else None
+)
+_TOKEN_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+_BASE_HEADERS = {"Content-Type": "application/json"}
+
+# Cache de token en memoria, con vencimiento (time.monotonic) y lock para renovarlo
 _SF_ACCESS_TOKEN: str | None = None
+_SF_AUTH_HEADER: str = ""  # "Bearer <token>", se recalcula solo cuando cambia el token
+_SF_TOKEN_EXPIRY: float = 0.0
+_TOKEN_LOCK = asyncio.Lock()
+
+# Salesforce no siempre manda expires_in; renovamos un minuto antes de vencer
+_SF_TOKEN_DEFAULT_TTL = 1800
+_SF_TOKEN_MARGIN = 60
+
+# Timeouts por fase: un pool trabado o un connect lento fallan rápido
+_SF_HTTP_TIMEOUT = httpx.Timeout(connect=2.0, read=4.0, write=2.0, pool=1.0)
 
+# Presupuesto total de la operación (token + llamada + reintento por 401)
+_SF_CALL_BUDGET = 8.0
 
-async def _get_salesforce_token() -> str:
+# Cliente HTTP compartido (keep-alive / HTTP/2) para no repetir el handshake TLS
+_client: httpx.AsyncClient | None = None
+
+
+def get_client() -> httpx.AsyncClient:
     """
-    Pide un access_token a Salesforce usando client_credentials.
-    En esta etapa de testeo, pedimos uno nuevo cuando hace falta.
+    Devuelve el cliente HTTP compartido, creándolo la primera vez.
     """
-    global _SF_ACCESS_TOKEN
+    global _client
+
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=_SF_HTTP_TIMEOUT,
+            limits=httpx.Limits(max_keepalive_connections=20),
+            http2=True,
+        )
+    return _client
 
-    if not SF_CLIENT_ID or not SF_CLIENT_SECRET:
+
+async def close_client() -> None:
+    """
+    Cierra el cliente HTTP compartido (se llama al apagar la app).
+    """
+    global _client
+
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def _get_salesforce_token(stale_token: str | None = None) -> str:
+    """
+    Devuelve un access_token de Salesforce (client_credentials), reusando el cacheado
+    mientras no venza. Si se pasa stale_token (p.ej. tras un 401), se descarta ese token.
+    El lock hace que ante una ráfaga de requests se pida un solo token nuevo.
+    """
+    if _TOKEN_BODY is None:
         raise RuntimeError("Faltan SF_CLIENT_ID / SF_CLIENT_SECRET en variables de entorno")
 
-    data = {
-        "grant_type": "client_credentials",
-        "client_id": SF_CLIENT_ID,
-        "client_secret": SF_CLIENT_SECRET,
-    }
+    async with _TOKEN_LOCK:
+        # Otra corrutina pudo haberlo renovado mientras esperábamos el lock
+        if (
+            _SF_ACCESS_TOKEN
+            and _SF_ACCESS_TOKEN != stale_token
+            and time.monotonic() < _SF_TOKEN_EXPIRY
+        ):
+            return _SF_ACCESS_TOKEN
+
+        return await _request_salesforce_token()
+
 
-    async with httpx.AsyncClient(timeout=10) as client:
-        resp = await client.post(SF_TOKEN_URL, data=data)
+async def _request_salesforce_token() -> str:
+    """
+    Pide un access_token nuevo a Salesforce y lo guarda en el cache.
+    """
+    global _SF_ACCESS_TOKEN, _SF_AUTH_HEADER, _SF_TOKEN_EXPIRY
+
+    client = get_client()
+    resp = await client.post(SF_TOKEN_URL, content=_TOKEN_BODY, headers=_TOKEN_HEADERS)
 
     if resp.status_code != 200:
         raise RuntimeError(f"Error al obtener token de Salesforce: {resp.status_code} - {resp.text}")
@@ -43,7 +113,10 @@ async def _get_salesforce_token() -> str:
     if not access_token:
         raise RuntimeError(f"Respuesta de token sin access_token: {token_json}")
 
+    expires_in = token_json.get("expires_in", _SF_TOKEN_DEFAULT_TTL)
     _SF_ACCESS_TOKEN = access_token
+    _SF_AUTH_HEADER = f"Bearer {access_token}"
+    _SF_TOKEN_EXPIRY = time.monotonic() + int(expires_in) - _SF_TOKEN_MARGIN
     return access_token
 
 
@@ -52,27 +125,35 @@ async def _call_salesforce_terminal_action(payload: Dict[str, Any]) -> httpx.Res
     Llama al endpoint Apex REST usando el token cacheado.
     Si recibe 401, pide un token nuevo y reintenta una vez.
     """
-    global _SF_ACCESS_TOKEN
-
-    # 1) Asegurarse de tener token
-    if not _SF_ACCESS_TOKEN:
-        _SF_ACCESS_TOKEN = await _get_salesforce_token()
-
-    headers = {
-        "Authorization": f"Bearer {_SF_ACCESS_TOKEN}",
-        "Content-Type": "application/json",
-    }
+    # 1) Asegurarse de tener token vigente (sin tocar el lock si el cache sirve)
+    token = _SF_ACCESS_TOKEN
+    if not token or time.monotonic() >= _SF_TOKEN_EXPIRY:
+        token = await _get_salesforce_token()
+
+    # _SF_AUTH_HEADER siempre corresponde al último token cacheado
+    client = get_client()
+    resp = await client.post(
+        SF_ENDPOINT, json=payload, headers={**_BASE_HEADERS, "Authorization": _SF_AUTH_HEADER}
+    )
+
+    # Si el token falló (expiró / fue revocado), pedimos otro y reintentamos una vez
+    if resp.status_code == 401:
+        await _get_salesforce_token(stale_token=token)
+        resp = await client.post(
+            SF_ENDPOINT, json=payload, headers={**_BASE_HEADERS, "Authorization": _SF_AUTH_HEADER}
+        )
 
-    async with httpx.AsyncClient(timeout=10) as client:
-        resp = await client.post(SF_ENDPOINT, json=payload, headers=headers)
+    return resp
 
-        # Si el token falló (expiró / fue revocado), pedimos otro y reintentamos una vez
-        if resp.status_code == 401:
-            _SF_ACCESS_TOKEN = await _get_salesforce_token()
-            headers["Authorization"] = f"Bearer {_SF_ACCESS_TOKEN}"
-            resp = await client.post(SF_ENDPOINT, json=payload, headers=headers)
 
-    return resp
+class SFTerminalResponse(msgspec.Struct, gc=False):
+    """
+    Campos que usamos de la respuesta del Apex; el resto se ignora al decodificar.
+    """
+    success: bool = False
+    message: Optional[str] = None
+    caseId: Optional[str] = None
+    error_code: Optional[str] = None
 
 
 async def update_serial_in_salesforce(serial: str, technicianName: str, role: str) -> Dict[str, Any]:
@@ -87,12 +168,22 @@ async def update_serial_in_salesforce(serial: str, technicianName: str, role: st
         "technicianName": technicianName  # Debe matchear el picklist
     }
 
-    response = await _call_salesforce_terminal_action(payload)
+    try:
+        response = await asyncio.wait_for(
+            _call_salesforce_terminal_action(payload), timeout=_SF_CALL_BUDGET
+        )
+    except (asyncio.TimeoutError, httpx.TimeoutException):
+        return {
+            "success": False,
+            "message": "Salesforce no respondió a tiempo",
+            "salesforce_id": None,
+            "error_code": "SF_TIMEOUT"
+        }
 
-    # Intentar parsear JSON
+    # Intentar parsear JSON (solo los campos que usamos, en una pasada)
     try:
-        sf_resp = response.json()
-    except Exception:
+        sf_resp = msgspec.json.decode(response.content, type=SFTerminalResponse)
+    except msgspec.DecodeError:
         return {
             "success": False,
             "message": f"Salesforce devolvió una respuesta no válida (HTTP {response.status_code})",
@@ -101,18 +192,18 @@ async def update_serial_in_salesforce(serial: str, technicianName: str, role: st
         }
 
     # Éxito (tu Apex ya devuelve success=true cuando todo sale bien)
-    if response.status_code == 200 and sf_resp.get("success") is True:
+    if response.status_code == 200 and sf_resp.success:
         return {
             "success": True,
-            "message": sf_resp.get("message", "Acción realizada correctamente."),
-            "salesforce_id": sf_resp.get("caseId"),
+            "message": sf_resp.message or "Acción realizada correctamente.",
+            "salesforce_id": sf_resp.caseId,
             "error_code": None,
         }
 
     # Error (mensaje desde tu Apex o genérico)
     return {
         "success": False,
-        "message": sf_resp.get("message", f"Error en Salesforce (HTTP {response.status_code})"),
-        "salesforce_id": sf_resp.get("caseId"),
-        "error_code": sf_resp.get("error_code") or f"SF_{response.status_code}",
+        "message": sf_resp.message or f"Error en Salesforce (HTTP {response.status_code})",
+        "salesforce_id": sf_resp.caseId,
+        "error_code": sf_resp.error_code or f"SF_{response.status_code}",
     }
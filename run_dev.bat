@@ -3,4 +3,5 @@ REM Activar el venv (asumiendo que ya existe)
 call venv\Scripts\activate
 
 REM Levantar el servidor en modo desarrollo
-uvicorn app.main:app --reload --port 8000
+REM --loop auto usa uvloop si esta instalado (no existe en Windows); --http httptools usa el parser en C
+uvicorn app.main:app --reload --port 8000 --loop auto --http httptools